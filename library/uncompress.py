@@ -33,7 +33,7 @@ options:
     description:
       - If copy=yes (default), local path to compressed file to copy to the target server; can be absolute or relative.
       - If copy=no, path on the target server to existing compressed file to unpack.
-      - If copy=no and src contains ://, the remote machine will download the file from the url first.
+      - If copy=no and src is an http, https, ftp or file url, the remote machine will download the file from the url first.
     required: true
     default: null
   dest:
@@ -53,12 +53,19 @@ options:
     required: false
     choices: [ "yes", "no" ]
     default: "no"
+  max_download_bytes:
+    description:
+      - "If src is a url, fail without downloading it when the server reports a Content-Length larger than this. 0 means no limit."
+    required: false
+    default: 10737418240
 author: "Jonathan Mainguy (@Jmainguy)"
 notes:
-    - requires C(file)/C(xz) commands on target host
-    - requires gzip and bzip python modules
+    - requires Python 3 on the target host
+    - requires zlib and bz2 python modules, and the lzma python module for I(xz) files
+    - uses the rapidgzip and indexed_bzip2 python modules, if installed on the target, to decompress in parallel
     - can handle I(gzip), I(bzip2) and I(xz) compressed files
     - detects type of compressed file automatically
+    - preallocates the output when the uncompressed size is known
 '''
 
 
@@ -82,83 +89,238 @@ changed:
 
 import os
 import shutil
-import gzip
+import stat
+import threading
+import struct
+import zlib
 import bz2
-import filecmp
+import mmap
+import queue
+import tempfile
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.urls import fetch_url
 from ansible.module_utils.pycompat24 import get_exception
 
+# lzma is left out of some Python builds, in which case only xz files can't be uncompressed
+try:
+    import lzma
+    HAS_LZMA = True
+except ImportError:
+    HAS_LZMA = False
+
+# Optional parallel decompressors, used when installed on the target
+try:
+    import rapidgzip
+    HAS_RAPIDGZIP = True
+except ImportError:
+    HAS_RAPIDGZIP = False
+
+try:
+    import indexed_bzip2
+    HAS_INDEXED_BZIP2 = True
+except ImportError:
+    HAS_INDEXED_BZIP2 = False
+
 
 # When downloading an archive, how much of the archive to download before
-# saving to a tempfile (64k)
-BUFSIZE = 65536
+# saving to a tempfile (1M)
+BUFSIZE = 1024 * 1024
+
+# src prefixes, matched case insensitively, which are downloaded with fetch_url rather than treated as a path
+URL_SCHEMES = ('http://', 'https://', 'ftp://', 'file://')
+
+# How many uncompressed chunks can be waiting to be written out
+WRITE_QUEUE_SIZE = 4
+
+# Largest archive to download when the server reports its size (10G)
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024 * 1024
+
+# How much uncompressed data to move per read/write when decompressing (1M)
+COPY_BUFSIZE = 1024 * 1024
 
+# How much compressed data to feed to the gzip and xz decompressors at a time (128k)
+READ_BUFSIZE = 128 * 1024
 
-def ungzip(src, dest):
+# zlib window bits for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Magic bytes at the start of each supported compressed file
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+# Sizes of the xz stream header and footer, and the magic bytes that end the footer
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+XZ_FOOTER_MAGIC = b'YZ'
+
+
+def gunzip_stream(f_in, f_out):
+    """
+    Decompress a gzip stream from f_in into f_out, handling multi-member files.
+    Compressed input is fed to zlib in READ_BUFSIZE chunks and the output is written
+    as it is produced, in pieces of at most COPY_BUFSIZE.
+    """
+    decomp = zlib.decompressobj(GZIP_WBITS)
+    while True:
+        data = f_in.read(READ_BUFSIZE)
+        if not data:
+            break
+        while data:
+            if decomp.eof:
+                # Start of the next member; trailing zero padding is ignored, as gzip does
+                data = data.lstrip(b'\x00')
+                if not data:
+                    break
+                decomp = zlib.decompressobj(GZIP_WBITS)
+            f_out.write(decomp.decompress(data, COPY_BUFSIZE))
+            if decomp.eof:
+                data = decomp.unused_data
+            else:
+                data = decomp.unconsumed_tail
+    # Flush whatever zlib still holds once all of the input has been consumed
+    while not decomp.eof:
+        chunk = decomp.decompress(b'', COPY_BUFSIZE)
+        if not chunk:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        f_out.write(chunk)
+
+
+def fadvise(f, advice):
+    """
+    Tell the kernel how f is going to be accessed, with one of the POSIX_FADV_* names minus the prefix.
+    Does nothing where posix_fadvise isn't available.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+
+def open_src(src, buffering=-1):
+    """
+    Open src for reading, advising the kernel it will be read sequentially so that it reads further ahead.
+    """
+    f = open(src, 'rb', buffering)
+    fadvise(f, 'SEQUENTIAL')
+    return f
+
+
+def close_src(f):
+    """
+    Close a file opened with open_src, dropping it from the page cache since it won't be read again.
+    """
+    try:
+        fadvise(f, 'DONTNEED')
+    finally:
+        f.close()
+
+
+def ungzip(src, f_out):
     """
     Uncompress gzip files.
     """
     try:
-        f_out = open(dest, 'wb')
-        f_in = gzip.open(src, 'rb')
-        try:
-            shutil.copyfileobj(f_in, f_out)
-        finally:
-            f_out.close()
-            f_in.close()
+        if HAS_RAPIDGZIP:
+            f_in = rapidgzip.open(src, parallelization=os.cpu_count())
+            try:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+            finally:
+                f_in.close()
+        else:
+            f_in = open_src(src, READ_BUFSIZE)
+            try:
+                gunzip_stream(f_in, f_out)
+            finally:
+                close_src(f_in)
         msg = ""
     except Exception:
         e = get_exception()
-        f_out.close()
-        f_in.close()
         msg = "%s" % e
 
     return msg
 
 
-def unbzip(src, dest):
+def unbzip(src, f_out):
     """
     Uncompress bzip files.
     """
     try:
-        f_out = open(dest, 'wb')
-        f_in = bz2.BZ2File(src, 'rb')
-        try:
-            shutil.copyfileobj(f_in, f_out)
-        finally:
-            f_out.close()
-            f_in.close()
+        if HAS_INDEXED_BZIP2:
+            f_in = indexed_bzip2.open(src, parallelization=os.cpu_count())
+            try:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+            finally:
+                f_in.close()
+        else:
+            f_raw = open_src(src)
+            try:
+                f_in = bz2.BZ2File(f_raw, 'rb')
+                try:
+                    shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+                finally:
+                    f_in.close()
+            finally:
+                close_src(f_raw)
         msg = ""
     except Exception:
         e = get_exception()
-        f_out.close()
-        f_in.close()
         msg = "%s" % e
 
     return msg
 
 
-def unxzip(module, src, dest):
+def unxz_stream(f_in, f_out):
     """
-    Uncompress xz files. Since we must support python 2.4 (EL 5) we cannot import lzma and use native python.
-    We guess the filename of the output. .xz and .lzma get stripped, .txz and .lzma get replaced with .tar
+    Decompress xz data from f_in into f_out, handling multiple streams and the stream padding between them,
+    which lzma.open stops at. Compressed input is read in READ_BUFSIZE chunks and the output is written as it
+    is produced, in pieces of at most COPY_BUFSIZE.
     """
-    cmd_path = module.get_bin_path('xz')
-    cmd = '%s -k -d %s' % (cmd_path, src)
-    # Guess filename of output
-    prefix, suffix = os.path.splitext(src)
-    if (suffix == '.xz') or (suffix == '.lzma'):
-        ufile = prefix
-    elif (suffix == '.txz') or (suffix == '.tlz'):
-        ufile = prefix + '.tar'
-    else:
-        module.fail_json(msg="xz does not understand suffix %s" % suffix)
+    decomp = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    padding = 0
+    while True:
+        data = f_in.read(READ_BUFSIZE)
+        if not data:
+            break
+        while data:
+            if decomp.eof:
+                # Stream padding is zero bytes in multiples of 4, then possibly the next stream
+                stripped = data.lstrip(b'\x00')
+                padding += len(data) - len(stripped)
+                data = stripped
+                if not data:
+                    break
+                if padding % 4:
+                    raise lzma.LZMAError("Stream padding is not a multiple of four bytes")
+                padding = 0
+                decomp = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            f_out.write(decomp.decompress(data, COPY_BUFSIZE))
+            # Input beyond max_length is held by the decompressor, drain it before feeding more
+            while not decomp.eof and not decomp.needs_input:
+                f_out.write(decomp.decompress(b'', COPY_BUFSIZE))
+            if decomp.eof:
+                data = decomp.unused_data
+            else:
+                data = b''
+    if not decomp.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+    if padding % 4:
+        raise lzma.LZMAError("Stream padding is not a multiple of four bytes")
+
+
+def unxzip(src, f_out):
+    """
+    Uncompress xz files.
+    """
+    if not HAS_LZMA:
+        return "Uncompressing xz files requires the python lzma module, which is missing on this host"
     try:
-        module.run_command(cmd)
-        if not os.path.isfile(ufile):
-            module.fail_json(msg="%s should have uncompressed to %s, but alas it did not" % (src, ufile))
-        shutil.move(ufile, dest)
+        f_in = open_src(src, READ_BUFSIZE)
+        try:
+            unxz_stream(f_in, f_out)
+        finally:
+            close_src(f_in)
         msg = ""
     except Exception:
         e = get_exception()
@@ -167,46 +329,355 @@ def unxzip(module, src, dest):
     return msg
 
 
-def filetype(module, src):
+class CompareFile(object):
+    """
+    Writable file object which compares what is written to it against the existing dest. Nothing is written
+    to tempsrc until the first difference, at which point the matching part of dest is copied over to it and
+    writing carries on from there.
+    """
+
+    def __init__(self, dest, tempsrc):
+        self.tempsrc = tempsrc
+        self.f_out = None
+        self.offset = 0
+        # dest is memory mapped, so comparing against it needs neither a read syscall nor a copy.
+        # An empty file can't be mapped, but then there is nothing to compare either.
+        f_dest = open(dest, 'rb')
+        try:
+            self.size = os.fstat(f_dest.fileno()).st_size
+            self.map = None
+            if self.size:
+                self.map = mmap.mmap(f_dest.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    self.map.madvise(mmap.MADV_SEQUENTIAL)
+        finally:
+            f_dest.close()
+
+    def write(self, data):
+        size = len(data)
+        if self.f_out is None:
+            if not size:
+                return 0
+            # find with a window exactly the size of data is a single memcmp at offset
+            if self.map is not None and self.map.find(data, self.offset, self.offset + size) == self.offset:
+                self.offset += size
+                return size
+            self._diverge()
+        return self.f_out.write(data)
+
+    def _diverge(self):
+        self.f_out = open(self.tempsrc, 'wb')
+        for start in range(0, self.offset, COPY_BUFSIZE):
+            self.f_out.write(self.map[start:min(start + COPY_BUFSIZE, self.offset)])
+
+    @property
+    def differs(self):
+        return self.f_out is not None
+
+    def close(self):
+        try:
+            # dest is longer than the uncompressed file
+            if self.f_out is None and self.offset != self.size:
+                self._diverge()
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+        Close without finishing off tempsrc, for when uncompressing failed part way.
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.f_out is not None:
+            self.f_out.close()
+
+
+class ThreadedWriter(object):
+    """
+    Writable file object which hands what is written to it to a background thread that writes it to f_out.
+    zlib, bz2, lzma and the write itself all release the GIL, so decompression and writing run in parallel.
+    At most WRITE_QUEUE_SIZE chunks are held waiting to be written.
+    """
+
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            # After a failure keep draining the queue, so that write() never blocks on it
+            if self.error is None:
+                try:
+                    self.f_out.write(data)
+                except Exception:
+                    self.error = get_exception()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        # The caller may reuse its buffer as soon as this returns, so take a copy of anything that isn't bytes.
+        # The uncompressors all hand over fresh bytes objects, so this doesn't normally happen.
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.queue.put(data)
+        return len(data)
+
+    def close(self):
+        """
+        Wait for everything to be written, raising the error if a write failed. f_out is left open.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def filetype(src):
+    """
+    Get the filetype from the magic bytes at the start of src, so that the correct compression method can be picked for it
+    """
+    f = open(src, 'rb')
+    try:
+        header = f.read(6)
+    finally:
+        f.close()
+
+    if header[:2] == GZIP_MAGIC:
+        return 'gzip'
+    elif header[:3] == BZIP2_MAGIC:
+        return 'x-bzip2'
+    elif header[:6] == XZ_MAGIC:
+        return 'x-xz'
+    return 'unknown'
+
+
+def gzip_isize(src):
     """
-    Get the filetype from the unix command file, and then pick the correct compression method to use for it
+    Get the uncompressed size, modulo 2^32, from the ISIZE field at the end of a gzip file, or None if the file
+    is too short to have one. For multi-member files this is only the size of the last member.
     """
-    cmd_path = module.get_bin_path('file')
-    cmd = "%s -b -i %s" % (cmd_path, src)
-    ftype = module.run_command(cmd)
+    f = open(src, 'rb')
+    try:
+        if f.seek(0, os.SEEK_END) < 4:
+            return None
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+    finally:
+        f.close()
 
-    return ftype
+
+def read_multibyte(buf, pos):
+    """
+    Decode an xz variable length integer from buf at pos, returning it and the position after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift >= 63:
+            raise ValueError("xz integer is too long")
+
+
+def xz_size(src):
+    """
+    Get the uncompressed size of an xz file by adding up the block sizes in the index of each stream, working
+    back from the stream footer at the end of the file. Returns None if the file can't be parsed.
+    """
+    total = 0
+    f = open(src, 'rb')
+    try:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            if end < XZ_HEADER_SIZE + XZ_FOOTER_SIZE:
+                return None
+            f.seek(end - XZ_FOOTER_SIZE)
+            footer = f.read(XZ_FOOTER_SIZE)
+            # Stream padding between or after streams
+            if footer[-4:] == b'\x00\x00\x00\x00':
+                end -= 4
+                continue
+            if footer[10:] != XZ_FOOTER_MAGIC or zlib.crc32(footer[4:10]) != struct.unpack('<I', footer[:4])[0]:
+                return None
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_start = end - XZ_FOOTER_SIZE - index_size
+            if index_start < XZ_HEADER_SIZE:
+                return None
+            f.seek(index_start)
+            index = f.read(index_size)
+            if index[0] != 0 or zlib.crc32(index[:-4]) != struct.unpack('<I', index[-4:])[0]:
+                return None
+            records, pos = read_multibyte(index, 1)
+            blocks_size = 0
+            for _ in range(records):
+                unpadded_size, pos = read_multibyte(index, pos)
+                uncompressed_size, pos = read_multibyte(index, pos)
+                blocks_size += (unpadded_size + 3) & ~3
+                total += uncompressed_size
+            end = index_start - blocks_size - XZ_HEADER_SIZE
+            if end < 0:
+                return None
+            f.seek(end)
+            if f.read(len(XZ_MAGIC)) != XZ_MAGIC:
+                return None
+    except (IndexError, ValueError):
+        return None
+    finally:
+        f.close()
+
+    return total
+
+
+def recorded_size(src, ftype):
+    """
+    Get the uncompressed size recorded in src, or None if the filetype doesn't record it.
+    """
+    if ftype == "gzip":
+        return gzip_isize(src)
+    elif ftype == "x-xz":
+        return xz_size(src)
+    return None
 
 
-def copyfile(src, dest, deep_check):
+def preallocate(f, size):
     """
-    Copy file from tempsrc to final destination. Unless its already at dest, and the same as tempsrc.
+    Reserve size bytes for f up front, so the filesystem can lay it out in one go rather than growing it a
+    write at a time. Does nothing if size is unknown, posix_fallocate isn't available, or size is more than
+    the free space on the filesystem, since size comes from the archive or server and may be wrong.
+    On filesystems without fallocate(2), such as NFSv3, glibc emulates it by writing to every block of the
+    range, which costs an extra write of the file. That cost is accepted rather than probing for support.
+    """
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            st = os.fstatvfs(f.fileno())
+            if size <= st.f_bavail * st.f_frsize:
+                os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def content_length(info):
+    """
+    Get the Content-Length from a fetch_url info dict. It is only used as a hint, so a missing, malformed or
+    negative header is treated as unknown and gives 0.
+    """
+    try:
+        length = int(info.get('content-length') or 0)
+    except (TypeError, ValueError):
+        return 0
+    return max(length, 0)
+
+
+def copyfile(src, dest, st_dest):
+    """
+    Move file from tempsrc to final destination. Unless its already at dest, and the same size as tempsrc, in
+    which case tempsrc is removed. tempsrc must be on the same filesystem as dest.
+    st_dest is the os.stat() result for dest, or None if dest is not an existing regular file.
     """
     changed = False
-    if os.path.isfile(dest):
-        # This takes a long time
-        if deep_check:
-            nodiff = filecmp.cmp(src, dest, shallow=True)
-        # This is much quicker
+    if st_dest is not None:
+        destsize = st_dest.st_size
+        srcsize = os.stat(src).st_size
+        if destsize != srcsize:
+            nodiff = False
         else:
-            destsize = os.path.getsize(dest)
-            srcsize = os.path.getsize(src)
-            if destsize != srcsize:
-                nodiff = False
-            else:
-                nodiff = True
+            nodiff = True
         # If there is a difference, then we change the destination
         if nodiff is False:
-            shutil.move(src, dest)
+            os.replace(src, dest)
             changed = True
+        else:
+            os.unlink(src)
     # If the destination file does not exist, then place it.
     else:
-        shutil.move(src, dest)
+        os.replace(src, dest)
         changed = True
 
     return changed
 
 
+def uncompress_file(module, uncompress, src, dest, st_dest, deep_check, size=None):
+    """
+    Uncompress src with the uncompress function and put the result at dest, unless dest is already the same.
+    st_dest is as for copyfile. size is the expected uncompressed size if known, which is preallocated up front.
+    """
+    fdir, ffile = os.path.split(dest)
+
+    # With deep_check, compare against dest while uncompressing and only write out tempsrc once they differ.
+    compare = deep_check and st_dest is not None
+    tempsrc = None
+    try:
+        # Uncompress next to dest, so that the result can be renamed into place rather than copied.
+        f = tempfile.NamedTemporaryFile(dir=fdir, prefix='.%s.' % ffile, delete=False)
+        tempsrc = f.name
+        f.close()
+        # NamedTemporaryFile creates the file as 0600, give it the mode a plain open() would have.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tempsrc, 0o666 & ~umask)
+
+        if compare:
+            f_out = CompareFile(dest, tempsrc)
+        else:
+            f_out = open(tempsrc, 'wb')
+            preallocate(f_out, size)
+    except (IOError, OSError):
+        e = get_exception()
+        if tempsrc is not None:
+            os.unlink(tempsrc)
+        module.fail_json(msg="%s" % e)
+
+    # Write out on a separate thread, so that uncompressing the next chunk overlaps writing the last one.
+    writer = ThreadedWriter(f_out)
+    msg = uncompress(src, writer)
+    try:
+        writer.close()
+        # size is only a hint, drop anything preallocated past the end of what was written
+        if not compare and size:
+            f_out.truncate()
+    except (IOError, OSError):
+        e = get_exception()
+        if msg == "":
+            msg = "%s" % e
+    try:
+        # tempsrc is thrown away after a failure, so don't have CompareFile fill it in with dest
+        if compare and msg != "":
+            f_out.abort()
+        else:
+            f_out.close()
+    except (IOError, OSError):
+        e = get_exception()
+        if msg == "":
+            msg = "%s" % e
+    if msg != "":
+        os.unlink(tempsrc)
+        module.fail_json(msg=msg)
+
+    if compare:
+        changed = f_out.differs
+        if changed:
+            os.replace(tempsrc, dest)
+        else:
+            os.unlink(tempsrc)
+    # If file already exists at dest, compare uncompressed file and dest sizes, and replace if different.
+    else:
+        changed = copyfile(tempsrc, dest, st_dest)
+
+    return changed
+
+
 def main():
     module = AnsibleModule(
         # not checking because of daisy chain to file module
@@ -215,7 +686,8 @@ def main():
             dest=dict(required=True),
             copy=dict(default=True, type='bool'),
             original_basename=dict(required=False),  # used to handle 'dest is a directory' via template, a slight hack
-            deep_check=dict(default=False, type='bool'),  # This check takes a long time if dest already exists.
+            deep_check=dict(default=False, type='bool'),  # Compares contents rather than just size if dest already exists.
+            max_download_bytes=dict(default=MAX_DOWNLOAD_BYTES, type='int'),
         ),
         add_file_common_args=True,
     )
@@ -224,16 +696,23 @@ def main():
     dest = os.path.expanduser(module.params['dest'])
     copy = module.params['copy']
     deep_check = module.params['deep_check']
+    max_download_bytes = module.params['max_download_bytes']
+    if max_download_bytes < 0:
+        module.fail_json(msg="max_download_bytes must be 0 or more, got %d" % max_download_bytes)
     file_args = module.load_file_common_arguments(module.params)
     tempdir = "/tmp/"
     fdir, ffile = os.path.split(dest)
 
     # did tar file arrive?
-    if not os.path.exists(src):
+    try:
+        st_src = os.stat(src)
+    except OSError:
+        st_src = None
+    if st_src is None:
         if copy:
             module.fail_json(msg="Source '%s' failed to transfer" % src)
-        # If copy=false, and src= contains ://, try and download the file to a temp directory.
-        elif '://' in src:
+        # If copy=false, and src= is a url, try and download the file to a temp directory.
+        elif src.lower().startswith(URL_SCHEMES):
             package = os.path.join(tempdir, str(src.rsplit('/', 1)[1]))
             try:
                 rsp, info = fetch_url(module, src)
@@ -242,24 +721,38 @@ def main():
                 if status_code != 200:
                     module.fail_json(msg="Failure downloading %s, %s" % (src, status_code))
 
-                f = open(package, 'wb')
-
-                f.write(rsp.read())
-                f.close()
+                # Check the size before writing anything, rather than finding out when the disk fills up
+                length = content_length(info)
+                if max_download_bytes and length > max_download_bytes:
+                    rsp.close()
+                    module.fail_json(msg="Failure downloading %s, %d bytes is larger than max_download_bytes %d" % (src, length, max_download_bytes))
+
+                try:
+                    f = open(package, 'wb')
+                    try:
+                        preallocate(f, length)
+                        shutil.copyfileobj(rsp, f, BUFSIZE)
+                        # The download may have been cut short, drop any preallocated space past its end
+                        if length:
+                            f.truncate()
+                    finally:
+                        f.close()
+                finally:
+                    rsp.close()
                 src = package
             except Exception:
                 e = get_exception()
-                # f.close()
                 module.fail_json(msg="Failure downloading %s, %s" % (src, e))
         else:
             module.fail_json(msg="Source '%s' does not exist" % src)
+        try:
+            st_src = os.stat(src)
+        except OSError:
+            module.fail_json(msg="Source '%s' not readable" % src)
 
     # skip working with 0 size archives
-    try:
-        if os.path.getsize(src) == 0:
-            module.fail_json(msg="Invalid archive '%s', the file is 0 bytes" % src)
-    except Exception:
-        module.fail_json(msg="Source '%s' not readable" % src)
+    if st_src.st_size == 0:
+        module.fail_json(msg="Invalid archive '%s', the file is 0 bytes" % src)
 
     # is dest OK to receive tar file?
     if not os.path.isdir(fdir):
@@ -268,26 +761,36 @@ def main():
     if not os.access(src, os.R_OK):
         module.fail_json(msg="Source '%s' not readable" % src)
 
-    if os.path.isdir(dest):
+    try:
+        st_dest = os.stat(dest)
+    except OSError:
+        st_dest = None
+    if st_dest is not None and stat.S_ISDIR(st_dest.st_mode):
         module.fail_json(msg="Destination '%s' is an existing directory, must be a file, consider using unarchive module for archives" % dest)
-
-    # Full path to the uncompressed file in the temp directory.
-    tempsrc = os.path.join(tempdir, ffile)
+    # Only an existing regular file is compared against, anything else just gets replaced.
+    if st_dest is not None and not stat.S_ISREG(st_dest.st_mode):
+        st_dest = None
 
     # Check what kind of compressed file the src is.
-    ftype = filetype(module, src)[1]
-    if "gzip" in ftype:
-        msg = ungzip(src, tempsrc)
-    elif "x-bzip2" in ftype:
-        msg = unbzip(src, tempsrc)
-    elif "x-xz" in ftype:
-        msg = unxzip(module, src, tempsrc)
+    ftype = filetype(src)
+    if ftype == "gzip":
+        uncompress = ungzip
+    elif ftype == "x-bzip2":
+        uncompress = unbzip
+    elif ftype == "x-xz":
+        uncompress = unxzip
     else:
         module.fail_json(msg="Filetype not supported by uncompress module. %s" % ftype)
-    if msg != "":
-        module.fail_json(msg=msg)
-    # If file already exists at dest, compare uncompressed file and dest, and replace if different.
-    changed = copyfile(tempsrc, dest, deep_check)
+
+    # gzip and xz record the uncompressed size. gzip only records it modulo 2^32, and only for the last member,
+    # so it is just a hint for preallocating. The xz index covers every stream exactly.
+    size = recorded_size(src, ftype)
+    # Without deep_check only the size of dest is compared, so if it already matches the xz index there is no
+    # need to uncompress anything.
+    if not deep_check and ftype == "x-xz" and size is not None and st_dest is not None and st_dest.st_size == size:
+        changed = False
+    else:
+        changed = uncompress_file(module, uncompress, src, dest, st_dest, deep_check, size)
 
     # do we need to change perms?
     file_args['path'] = dest